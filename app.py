@@ -5,8 +5,11 @@ import aiopath
 import argparse
 import asyncio
 import base64
+import collections
 import concurrent.futures
 import functools
+import gzip
+import hashlib
 import jinja2
 import json
 import logging
@@ -63,6 +66,11 @@ if settings.file_server.enable_header_files:
 if settings.file_server.enable_video_thumbnail:
     # noinspection PyUnresolvedReferences
     import cv2
+if settings.file_server.enable_compression:
+    try:
+        import brotli
+    except ImportError:  # brotli is optional, gzip will be used on its own
+        brotli = None
 
 # Handle mimetypes
 icon_db = json.load(open(os.path.join(
@@ -120,6 +128,78 @@ app.jinja_env.trim_blocks = True
 app.url_map.strict_slashes = False
 
 
+# Compression
+compressible_mimetypes = ['application/javascript', 'application/json', 'application/xml', 'image/svg+xml']
+listing_cache = collections.OrderedDict()  # digest of rendered listing -> {encoding: compressed listing}
+
+
+def _compress(data: bytes, encoding: str, static: bool = False):
+    # Static files and assets are only compressed once, so they get the highest levels
+    if encoding == 'br':
+        return brotli.compress(data, quality=(11 if static else 5))
+    elif encoding == 'gzip':
+        return gzip.compress(data, compresslevel=(9 if static else 6), mtime=0)
+    raise ValueError(f'Invalid content encoding: {encoding}')
+
+
+def _available_encodings():
+    if not settings.file_server.enable_compression:
+        return []
+    elif brotli:
+        return ['br', 'gzip']
+    return ['gzip']
+
+
+def _negotiate_encoding(encodings: list):
+    # The first encoding in the list wins on ties, so br gets picked over gzip when a browser accepts both
+    encodings = [encoding for encoding in encodings if request.accept_encodings[encoding] > 0]
+    if not encodings:
+        return None
+    return max(encodings, key=lambda _e: request.accept_encodings[_e])
+
+
+def _precompress_directory(path: Union[str, os.PathLike]):
+    files = dict()
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(root, filename)
+            with open(file_path, 'rb') as fh:
+                data = fh.read()
+            file = dict()
+            file['digest'] = hashlib.sha256(data).hexdigest()[:16]
+            file['modified_at_raw'] = os.path.getmtime(file_path)
+            file['mimetype'] = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+            file['encodings'] = dict()
+            if file['mimetype'].startswith('text/') or file['mimetype'] in compressible_mimetypes:
+                for encoding in _available_encodings():
+                    compressed = _compress(data, encoding, static=True)
+                    if len(compressed) < len(data):  # don't bother with anything that doesn't get smaller
+                        file['encodings'][encoding] = compressed
+            files[os.path.relpath(file_path, path).replace(os.sep, '/')] = file
+    return files
+
+
+static_files = _precompress_directory(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'static'))
+theme_assets = _precompress_directory(os.path.join(settings.file_server.theme, 'assets'))
+
+
+def static_url(file: str):
+    url = f'{settings.web_server.base_path}/_/static/{file}'
+    if file in static_files:  # content-hashed URLs can be cached forever, see `send_precompressed`
+        url += '?v=' + static_files[file]['digest']
+    return url
+
+
+def asset_url(file: str):
+    url = f'{settings.web_server.base_path}/_/assets/{file}'
+    if file in theme_assets:
+        url += '?v=' + theme_assets[file]['digest']
+    return url
+
+
+app.jinja_env.globals.update(static_url=static_url, asset_url=asset_url)
+
+
 # noinspection PyUnresolvedReferences
 async def dir_walk(actual_path: str, full_path: Union[str, os.PathLike, Path]):
     # *_symbolstart is to get around natsort ignoring starting symbols when sorting
@@ -359,24 +439,44 @@ def _page_thumbnail(path: str, tiny: None = None):
     return i
 
 
+async def send_precompressed(directory: Union[str, os.PathLike], files: dict, actual_path: str):
+    file = files.get(actual_path)
+    encoding = _negotiate_encoding(list(file['encodings'].keys())) if file else None
+    if encoding:
+        etag = f'{file["digest"]}-{encoding}'
+        if request.if_none_match.contains(etag):
+            resp = await make_response('', 304)
+        else:
+            # mimetype (rather than a raw Content-Type) gets the same charset as send_from_directory
+            resp = app.response_class(file['encodings'][encoding], 200, mimetype=file['mimetype'])
+            resp.headers['Content-Encoding'] = encoding
+        resp.set_etag(etag)
+        resp.last_modified = datetime.utcfromtimestamp(file['modified_at_raw'])
+    else:
+        resp = await make_response(await send_from_directory(directory, actual_path))
+    if file and file['encodings']:
+        resp.vary.add('Accept-Encoding')
+    if file and request.args.get('v', None) == file['digest']:  # the URL changes whenever the file does
+        resp.headers['Cache-Control'] = 'max-age=31536000, immutable'
+    return resp
+
+
 @app.route('/_/static/<path:actual_path>')
 async def serve_static(actual_path):
-    resp = await make_response(
-        await send_from_directory(Path(__file__).parent.joinpath('static'), actual_path)
-    )
-    resp.headers['Cache-Control'] = 'max-age=604800, must-revalidate'  # static files can change between updates
+    resp = await send_precompressed(Path(__file__).parent.joinpath('static'), static_files, actual_path)
+    if 'immutable' not in resp.headers.get('Cache-Control', ''):
+        resp.headers['Cache-Control'] = 'max-age=604800, must-revalidate'  # static files can change between updates
     return resp
 
 
 @app.route('/_/assets/<path:actual_path>')
 async def serve_assets(actual_path):
-    resp = await make_response(
-        await send_from_directory(Path(__file__).parent.joinpath(settings.file_server.theme)
-                                  .joinpath('assets'), actual_path)
-    )
-    resp.headers['Cache-Control'] = 'max-age=604800'  # assets don't really change much
-    if Path(actual_path).suffix.lstrip('.') in ['css', 'js']:  # unless they're used for styling
-        resp.headers['Cache-Control'] += ', must-revalidate'  # in which case you want that being fresh if "stale"
+    resp = await send_precompressed(Path(__file__).parent.joinpath(settings.file_server.theme).joinpath('assets'),
+                                    theme_assets, actual_path)
+    if 'immutable' not in resp.headers.get('Cache-Control', ''):
+        resp.headers['Cache-Control'] = 'max-age=604800'  # assets don't really change much
+        if Path(actual_path).suffix.lstrip('.') in ['css', 'js']:  # unless they're used for styling
+            resp.headers['Cache-Control'] += ', must-revalidate'  # in which case you want that being fresh if "stale"
     return resp
 
 
@@ -540,6 +640,32 @@ async def serve_dir(full_path, actual_path, thumbnail: bool = False):
     )
     # Wed, 05 Jul 2023 06:43:12 GMT for /public
     resp.date = datetime.utcfromtimestamp((await Path(full_path).stat()).st_mtime)
+    if not thumbnail:  # the thumbnailer reads the page data directly
+        resp = await compress_listing(resp)
+    return resp
+
+
+async def compress_listing(resp):
+    encodings = _available_encodings()
+    if not encodings:
+        return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = _negotiate_encoding(encodings)
+    if not encoding:
+        return resp
+    data = await resp.get_data()
+    digest = hashlib.sha256(data).hexdigest()
+    # Listings are rendered fresh every time, but the compressed variants are cached per rendered listing.
+    cached = listing_cache.get(digest, dict())
+    if encoding not in cached:
+        cached[encoding] = await run_sync(_compress)(data, encoding)
+    if settings.file_server.listing_cache_size:
+        listing_cache[digest] = cached
+        listing_cache.move_to_end(digest)
+        while len(listing_cache) > settings.file_server.listing_cache_size:
+            listing_cache.popitem(last=False)
+    resp.set_data(cached[encoding])
+    resp.headers['Content-Encoding'] = encoding
     return resp
 
 
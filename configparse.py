@@ -35,6 +35,15 @@ class FileServer(BaseModel):
     enable_video_thumbnail: Optional[bool] = False
     thumbimage_cache_dir: Optional[str] = os.path.join(app_path, 'cache', 'thumbimage')
     wkhtmltoimage_cache_dir: Optional[str] = os.path.join(app_path, 'cache', 'wkhtmltoimage')
+    enable_compression: Optional[bool] = True
+    listing_cache_size: Optional[int] = 64
+
+    @field_validator('listing_cache_size')
+    def validate_listing_cache_size(cls, size):
+        if size < 0:
+            raise ValueError(f'Invalid listing cache size: {size}\n'
+                             'The listing cache size must be 0 (disabled) or higher.')
+        return size
 
     @field_validator('theme')
     def theme_exists(cls, path):